@@ -1,12 +1,24 @@
-import json
+import asyncio
+import gzip
+import hashlib
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import pandas as pd
 import streamlit as st
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
 from options_loader import load_options
-from db import get_engine, upsert_swatch, fetch_all
-from llm import extract_metadata, generate_description, validate_categorical
+from db import (
+    get_engine, upsert_swatch, upsert_swatches_bulk, fetch_all, fetch_preview,
+    dataset_signature, find_similar,
+)
+from llm import (
+    encode_image, image_phash, extract_metadata, generate_description, validate_categorical,
+    submit_batch, poll_batch, load_batch_results,
+)
+from parallel_processor import process_batch, describe_batch
 
 st.set_page_config(page_title="Swatch Metadata Extractor", layout="wide")
 st.title("Wallpaper Swatch Metadata Extractor")
@@ -14,10 +26,14 @@ st.title("Wallpaper Swatch Metadata Extractor")
 # ---------- Load options ----------
 @st.cache_data
 def _cached_options():
-    return load_options()
+    color_opts, design_opts, theme_opts = load_options()
+    # value -> position, for O(1) selectbox default lookup
+    color_idx = {v: i for i, v in enumerate(color_opts)}
+    design_idx = {v: i for i, v in enumerate(design_opts)}
+    theme_idx = {v: i for i, v in enumerate(theme_opts)}
+    return color_opts, design_opts, theme_opts, color_idx, design_idx, theme_idx
 
-color_opts, design_opts, theme_opts = _cached_options()
-color_set, design_set, theme_set = set(color_opts), set(design_opts), set(theme_opts)
+color_opts, design_opts, theme_opts, color_idx, design_idx, theme_idx = _cached_options()
 
 # ---------- Secrets ----------
 # For local: put in .streamlit/secrets.toml
@@ -32,50 +48,205 @@ if not DATABASE_URL:
     st.error("Missing DATABASE_URL in Streamlit secrets.")
     st.stop()
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-engine = get_engine(DATABASE_URL)
+# Cached per process so the HTTP keep-alive pool and DB connection pool
+# survive reruns and are shared across sessions.
+@st.cache_resource
+def _client(api_key):
+    return OpenAI(api_key=api_key)
+
+@st.cache_resource
+def _engine(database_url):
+    return get_engine(database_url)
+
+client = _client(OPENAI_API_KEY)
+try:
+    engine = _engine(DATABASE_URL)
+except RuntimeError as e:  # schema check (e.g. missing jsonb migration)
+    st.error(str(e))
+    st.stop()
 
 # ---------- Session state ----------
+def _meta_sig(meta):
+    # 16-byte digest of the canonical JSON; compared instead of the JSON text.
+    return hashlib.blake2b(orjson.dumps(meta, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+
 def _init_state():
     st.session_state.setdefault("draft_meta", None)        # last extracted + editable draft
     st.session_state.setdefault("accepted_meta", None)     # frozen snapshot after Accept
+    st.session_state.setdefault("accepted_sig", None)      # _meta_sig(accepted_meta), set on Accept
     st.session_state.setdefault("meta_dirty", False)       # if user edits after accept
     st.session_state.setdefault("description", "")         # generated/editable text
     st.session_state.setdefault("desc_based_on_meta", None)# snapshot used for current description
+    st.session_state.setdefault("batch_results", None)     # rows from last batch extraction
+    st.session_state.setdefault("extract_job", None)       # (image_hash, future) of in-flight extraction
+    st.session_state.setdefault("phash_checked", None)     # image_hash already looked up for near-duplicates
+    st.session_state.setdefault("reused_from", None)       # swatch_id whose metadata seeded the draft
+    st.session_state.setdefault("draft_errs", [])          # validate_categorical errors for a reused draft
 
 _init_state()
 
 # ---------- Sidebar: Download anytime ----------
-st.sidebar.header("Dataset")
-rows = fetch_all(engine)
-if rows:
+# Full-table reads are cached on a cheap (max(updated_at), count) probe,
+# so widget reruns don't rescan the table or re-encode the CSV.
+def _to_display_df(rows):
     df = pd.DataFrame(rows)
+    # secondary_colors arrives as a list (jsonb) -> readable string for CSV.
+    # Plain comprehension over .values: no per-row accessor dispatch, and
+    # NULL becomes "" instead of NaN.
+    if "secondary_colors" in df.columns:
+        df["secondary_colors"] = [", ".join(v) if v else "" for v in df["secondary_colors"].values]
+    return df
+
+# Bounded like _dataset_preview: only the current export is kept.
+@st.cache_data(show_spinner=False, max_entries=1, ttl="10m")
+def _dataset_csv_gz(_engine, sig):
+    # Stream the CSV through gzip in chunks instead of building one big str.
+    df = _to_display_df(fetch_all(_engine, limit=None))
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as gz:
+        df.to_csv(gz, index=False, encoding="utf-8", chunksize=10_000)
+    return buf.getvalue()
+
+# One entry per dataset signature; older signatures are evicted, and the
+# ttl drops the entry entirely when the sidebar sits idle.
+@st.cache_data(show_spinner=False, max_entries=1, ttl="10m")
+def _dataset_preview(_engine, sig):
+    return _to_display_df(fetch_preview(_engine, limit=25))
+
+@st.fragment
+def _dataset_sidebar():
+    # Own fragment: export/preview clicks rerun only this block, and
+    # editor-only reruns elsewhere don't re-probe the dataset.
+    st.header("Dataset")
+    dataset_sig = dataset_signature(engine)
+    if not dataset_sig[1]:
+        st.info("No saved records yet.")
+        return
+    # Export is only built on request (and then cached for this dataset_sig).
+    if st.button("📦 Prepare CSV export", use_container_width=True):
+        st.session_state.export_sig = dataset_sig
+    if st.session_state.get("export_sig") == dataset_sig:
+        st.download_button(
+            "⬇️ Download CSV (gzip)",
+            data=_dataset_csv_gz(engine, dataset_sig),
+            file_name="swatch_dataset.csv.gz",
+            mime="application/gzip",
+            use_container_width=True,
+        )
+    with st.expander("Preview latest rows"):
+        st.dataframe(_dataset_preview(engine, dataset_sig), use_container_width=True)
+
+with st.sidebar:
+    _dataset_sidebar()
 
-    # Convert secondary_colors JSON string -> readable string for CSV
-    def pretty_secondary(x):
-        try:
-            arr = json.loads(x) if isinstance(x, str) else []
-            if isinstance(arr, list):
-                return ", ".join(arr)
-        except Exception:
-            pass
-        return str(x) if x is not None else ""
+st.divider()
 
-    if "secondary_colors" in df.columns:
-        df["secondary_colors"] = df["secondary_colors"].apply(pretty_secondary)
-
-    csv_bytes = df.to_csv(index=False).encode("utf-8")
-    st.sidebar.download_button(
-        "⬇️ Download CSV",
-        data=csv_bytes,
-        file_name="swatch_dataset.csv",
-        mime="text/csv",
-        use_container_width=True,
+# ---------- Batch: many images at once ----------
+with st.expander("Batch extract (multiple images)"):
+    st.caption(
+        "Extracts metadata and descriptions for all images concurrently. "
+        "swatch_id is taken from each filename. Rows failing validation are not saved."
+    )
+    batch_files = st.file_uploader(
+        "Upload swatch images",
+        type=["png", "jpg", "jpeg", "webp"],
+        accept_multiple_files=True,
+        key="batch_uploader",
+    )
+
+    if batch_files and st.button("🚀 Run batch extraction", use_container_width=True):
+        images = [(os.path.splitext(f.name)[0], f.name, f.getvalue()) for f in batch_files]
+
+        async def _run_batch():
+            # Async client is bound to this event loop, so build it per run.
+            async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+            try:
+                return await process_batch(async_client, images, color_opts, design_opts, theme_opts)
+            finally:
+                await async_client.close()
+
+        with st.spinner(f"Processing {len(images)} images..."):
+            st.session_state.batch_results = asyncio.run(_run_batch())
+
+    results = st.session_state.batch_results
+    if results:
+        ok_rows = [r for r in results if not r["errors"]]
+        st.dataframe(
+            pd.DataFrame([{**r, "errors": "; ".join(r["errors"])} for r in results]),
+            use_container_width=True,
+        )
+        st.caption(f"{len(ok_rows)} of {len(results)} rows ready to save.")
+        if ok_rows and st.button("💾 Save batch (overwrite by swatch_id)", use_container_width=True):
+            try:
+                upsert_swatches_bulk(engine, ok_rows)
+                st.session_state.batch_results = None
+                st.success(f"Saved {len(ok_rows)} rows ✅")
+            except Exception as e:
+                st.error(f"Batch save failed: {e}")
+
+# ---------- Batch API: overnight backfill ----------
+with st.expander("Enqueue batch (OpenAI Batch API, ~24h)"):
+    st.caption(
+        "For large catalog backfills: metadata is extracted server-side at lower cost "
+        "without using the real-time rate limit. Come back later with the batch id to save."
+    )
+    backfill_files = st.file_uploader(
+        "Upload swatch images",
+        type=["png", "jpg", "jpeg", "webp"],
+        accept_multiple_files=True,
+        key="batch_api_uploader",
     )
-    with st.sidebar.expander("Preview latest rows"):
-        st.dataframe(df.head(25), use_container_width=True)
-else:
-    st.sidebar.info("No saved records yet.")
+    if backfill_files and st.button("📨 Enqueue batch", use_container_width=True):
+        images = [(os.path.splitext(f.name)[0], f.name, f.getvalue()) for f in backfill_files]
+        try:
+            with st.spinner(f"Uploading {len(images)} requests..."):
+                batch_id = submit_batch(client, images, color_opts, design_opts, theme_opts)
+            st.session_state.batch_api_id = batch_id
+            st.success(f"Enqueued batch `{batch_id}`")
+        except Exception as e:
+            st.error(f"Batch submit failed: {e}")
+
+    batch_id = st.text_input("Batch id", key="batch_api_id").strip()
+    if batch_id:
+        q1, q2 = st.columns([1, 1])
+        with q1:
+            if st.button("🔄 Check status", use_container_width=True):
+                try:
+                    st.json(poll_batch(client, batch_id))
+                except Exception as e:
+                    st.error(f"Status check failed: {e}")
+        with q2:
+            if st.button("💾 Load results + describe + save", use_container_width=True):
+                try:
+                    rows = load_batch_results(client, batch_id)
+                    # Options may have changed since submit (up to 24h ago): apply the
+                    # same save gate as process_batch before describing/saving.
+                    opt_sets = (set(color_opts), set(design_opts), set(theme_opts))
+                    for r in rows:
+                        if not r["errors"]:
+                            r["errors"] = validate_categorical(r, *opt_sets)
+
+                    async def _describe():
+                        async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+                        try:
+                            return await describe_batch(async_client, rows)
+                        finally:
+                            await async_client.close()
+
+                    with st.spinner(f"Generating {len(rows)} descriptions..."):
+                        rows = asyncio.run(_describe())
+                    ok_rows = [r for r in rows if not r["errors"]]
+                    upsert_swatches_bulk(engine, ok_rows)
+                    st.success(f"Saved {len(ok_rows)} of {len(rows)} rows ✅")
+                    failed = [r for r in rows if r["errors"]]
+                    if failed:
+                        st.dataframe(
+                            pd.DataFrame([{"swatch_id": r["swatch_id"], "errors": "; ".join(r["errors"])}
+                                          for r in failed]),
+                            use_container_width=True,
+                        )
+                except Exception as e:
+                    st.error(f"Loading batch results failed: {e}")
 
 st.divider()
 
@@ -93,7 +264,10 @@ if not uploaded:
     st.info("Upload a swatch image to begin.")
     st.stop()
 
-image_bytes = uploaded.read()
+# getvalue() returns the uploader's underlying bytes object without copying
+# (and, unlike read(), is not empty on reruns). Content hash keys the caches.
+image_bytes = uploaded.getvalue()
+image_hash = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
 filename = uploaded.name
 default_swatch_id = os.path.splitext(filename)[0]
 swatch_id = swatch_id_input.strip() if swatch_id_input.strip() else default_swatch_id
@@ -107,38 +281,125 @@ st.divider()
 
 
 # ---------- Extract / Regenerate metadata ----------
+@st.cache_data(show_spinner=False, max_entries=8, ttl="1h")
+def _encoded_image(_image_bytes, image_hash: str) -> str:
+    # Keyed on the content hash only, so Regenerate doesn't re-resize/re-encode.
+    return encode_image(_image_bytes)
+
+@st.cache_resource
+def _executor():
+    # Shared across sessions; the OpenAI call is I/O-bound so threads suffice.
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_data(show_spinner=False, max_entries=8, ttl="1h")
+def _image_phash(_image_bytes, image_hash: str) -> int:
+    return image_phash(_image_bytes)
+
+def _apply_extracted(meta, reused_from=None):
+    # Ensure required keys exist
+    meta.setdefault("primary_color", "")
+    meta.setdefault("secondary_colors", [])
+    meta.setdefault("design_style", "")
+    meta.setdefault("theme", "")
+    meta.setdefault("suitable_for", "")
+    st.session_state.draft_meta = meta
+    st.session_state.accepted_meta = None
+    st.session_state.meta_dirty = False
+    st.session_state.description = ""
+    st.session_state.desc_based_on_meta = None
+    st.session_state.reused_from = reused_from
+    st.session_state.draft_errs = []
+
+@st.fragment(run_every=1.0)
+def _extract_poller():
+    # Reruns on its own every second; triggers a full rerun once the job is done.
+    job = st.session_state.extract_job
+    if job is None or job[1].done():
+        st.rerun()
+    st.info("Extracting metadata from image... you can keep editing meanwhile.")
+
+# Pick up a finished background extraction before rendering the editor.
+# The UI stays live while extracting, so the upload may have changed since
+# the job was submitted: only apply results for the image now shown.
+job = st.session_state.extract_job
+if job is not None and job[1].done():
+    st.session_state.extract_job = None
+    job_hash, fut = job
+    if job_hash != image_hash:
+        st.warning("Discarded metadata extracted for a previously uploaded image.")
+    else:
+        try:
+            _apply_extracted(fut.result())
+        except Exception as e:
+            st.error(f"Metadata extraction failed: {e}")
+
+try:
+    image_ph = _image_phash(image_bytes, image_hash)
+except Exception:
+    image_ph = None  # dedup is best-effort
+
+# Near-duplicate of a saved swatch? Seed the draft from it instead of a paid
+# extraction (checked once per uploaded image).
+if (
+    image_ph is not None
+    and st.session_state.phash_checked != image_hash
+    and st.session_state.extract_job is None
+):
+    st.session_state.phash_checked = image_hash
+    try:
+        match = find_similar(engine, image_ph, max_distance=4)
+    except Exception:
+        match = None
+    if match:
+        _apply_extracted(
+            {k: match.get(k) for k in
+             ("primary_color", "secondary_colors", "design_style", "theme", "suitable_for")},
+            reused_from=match["swatch_id"],
+        )
+        # Saved rows were never checked by the strict schema (and options may
+        # have changed since), so validate them instead of silently
+        # falling back to the first option in each selectbox.
+        st.session_state.draft_errs = validate_categorical(
+            st.session_state.draft_meta, set(color_idx), set(design_idx), set(theme_idx)
+        )
+
+if st.session_state.reused_from:
+    st.info(
+        f"Metadata reused from similar saved swatch `{st.session_state.reused_from}`. "
+        "Click **Extract / Regenerate metadata** for a fresh extraction."
+    )
+    if st.session_state.draft_errs:
+        st.warning(
+            "Reused metadata needs review (you can correct using dropdowns):\n- "
+            + "\n- ".join(st.session_state.draft_errs)
+        )
+
 cA, cB = st.columns([1, 3])
 with cA:
-    if st.button("🔎 Extract / Regenerate metadata", use_container_width=True):
-        with st.spinner("Extracting metadata from image..."):
-            try:
-                meta = extract_metadata(client, image_bytes, color_opts, design_opts, theme_opts)
-                # Ensure required keys exist
-                meta.setdefault("primary_color", "")
-                meta.setdefault("secondary_colors", [])
-                meta.setdefault("design_style", "")
-                meta.setdefault("theme", "")
-                meta.setdefault("suitable_for", "")
-                st.session_state.draft_meta = meta
-                st.session_state.accepted_meta = None
-                st.session_state.meta_dirty = False
-                st.session_state.description = ""
-                st.session_state.desc_based_on_meta = None
-            except Exception as e:
-                st.error(f"Metadata extraction failed: {e}")
+    if st.button(
+        "🔎 Extract / Regenerate metadata",
+        use_container_width=True,
+        disabled=st.session_state.extract_job is not None,
+    ):
+        st.session_state.extract_job = (image_hash, _executor().submit(
+            extract_metadata,
+            client, image_bytes, color_opts, design_opts, theme_opts,
+            img_b64=_encoded_image(image_bytes, image_hash),
+        ))
+        st.rerun()  # re-render with the button disabled and the poller running
+
+with cB:
+    if st.session_state.extract_job is not None:
+        _extract_poller()
 
 # If no draft yet, force user to extract first
 if st.session_state.draft_meta is None:
-    st.warning("Click **Extract / Regenerate metadata** to generate the initial metadata draft.")
+    if st.session_state.extract_job is None:
+        st.warning("Click **Extract / Regenerate metadata** to generate the initial metadata draft.")
     st.stop()
 
 draft = st.session_state.draft_meta
 
-# ---------- Show validation warnings (but allow user correction) ----------
-errs = validate_categorical(draft, color_set, design_set, theme_set)
-if errs:
-    st.warning("LLM output needs review (you can correct using dropdowns):\n- " + "\n- ".join(errs))
-
 st.subheader("Step 1 — Review / Edit metadata (options-restricted)")
 
 # ---------- Editable controls (restricted to options) ----------
@@ -151,75 +412,81 @@ def _mark_dirty():
         st.session_state.accepted_meta = None
         st.session_state.description = ""
         st.session_state.desc_based_on_meta = None
-
-# Determine default indices safely
-def safe_index(options, value):
-    try:
-        return options.index(value)
-    except Exception:
-        return 0
-
-e1, e2, e3, e4, e5 = st.columns([1, 2, 1, 1, 2])
-
-with e1:
-    primary = st.selectbox(
-        "Primary color",
-        options=color_opts,
-        index=safe_index(color_opts, draft.get("primary_color")),
-        on_change=_mark_dirty,
-    )
-
-with e2:
-    secondary_default = [x for x in (draft.get("secondary_colors") or []) if x in color_set]
-    secondary = st.multiselect(
-        "Secondary colors (add/remove)",
-        options=color_opts,
-        default=secondary_default,
-        on_change=_mark_dirty,
-    )
-
-with e3:
-    design_style = st.selectbox(
-        "Design style",
-        options=design_opts,
-        index=safe_index(design_opts, draft.get("design_style")),
-        on_change=_mark_dirty,
-    )
-
-with e4:
-    theme = st.selectbox(
-        "Theme",
-        options=theme_opts,
-        index=safe_index(theme_opts, draft.get("theme")),
-        on_change=_mark_dirty,
-    )
-
-with e5:
-    suitable_for = st.text_input(
-        "Suitable for (free text)",
-        value=str(draft.get("suitable_for") or ""),
-        on_change=_mark_dirty,
-    )
-
-final_meta = {
-    "primary_color": primary,
-    "secondary_colors": secondary,
-    "design_style": design_style,
-    "theme": theme,
-    "suitable_for": suitable_for,
-}
-
-b1, b2 = st.columns([1, 1])
-
-with b1:
-    if st.button("✅ Accept metadata", use_container_width=True):
-        st.session_state.accepted_meta = final_meta
-        st.session_state.meta_dirty = False
-        st.success("Metadata accepted. You can now generate the description.")
-
-with b2:
-    if st.session_state.meta_dirty:
-        st.warning("Metadata changed after acceptance. Please Accept again to generate description.")
+        st.session_state.editor_needs_rerun = True
+
+@st.fragment
+def _metadata_editor(draft):
+    # Widget edits rerun only this fragment. Anything that changes Step 2
+    # (Accept, or an edit that invalidates acceptance) escalates to a full rerun.
+    if st.session_state.pop("editor_needs_rerun", False):
+        st.rerun()
+
+    e1, e2, e3, e4, e5 = st.columns([1, 2, 1, 1, 2])
+
+    with e1:
+        primary = st.selectbox(
+            "Primary color",
+            options=color_opts,
+            index=color_idx.get(draft.get("primary_color"), 0),
+            on_change=_mark_dirty,
+        )
+
+    with e2:
+        secondary_default = [x for x in (draft.get("secondary_colors") or []) if x in color_idx]
+        secondary = st.multiselect(
+            "Secondary colors (add/remove)",
+            options=color_opts,
+            default=secondary_default,
+            on_change=_mark_dirty,
+        )
+
+    with e3:
+        design_style = st.selectbox(
+            "Design style",
+            options=design_opts,
+            index=design_idx.get(draft.get("design_style"), 0),
+            on_change=_mark_dirty,
+        )
+
+    with e4:
+        theme = st.selectbox(
+            "Theme",
+            options=theme_opts,
+            index=theme_idx.get(draft.get("theme"), 0),
+            on_change=_mark_dirty,
+        )
+
+    with e5:
+        suitable_for = st.text_input(
+            "Suitable for (free text)",
+            value=str(draft.get("suitable_for") or ""),
+            on_change=_mark_dirty,
+        )
+
+    final_meta = {
+        "primary_color": primary,
+        "secondary_colors": secondary,
+        "design_style": design_style,
+        "theme": theme,
+        "suitable_for": suitable_for,
+    }
+
+    b1, b2 = st.columns([1, 1])
+
+    with b1:
+        if st.button("✅ Accept metadata", use_container_width=True):
+            st.session_state.accepted_meta = final_meta
+            st.session_state.accepted_sig = _meta_sig(final_meta)
+            st.session_state.meta_dirty = False
+            st.rerun()  # Step 2 lives outside this fragment
+        if st.session_state.accepted_meta is not None:
+            st.success("Metadata accepted. You can now generate the description.")
+
+    with b2:
+        if st.session_state.meta_dirty:
+            st.warning("Metadata changed after acceptance. Please Accept again to generate description.")
+
+_metadata_editor(draft)
 
 st.divider()
 
@@ -240,7 +507,7 @@ with d1:
             try:
                 desc = generate_description(client, accepted)
                 st.session_state.description = desc
-                st.session_state.desc_based_on_meta = json.dumps(accepted, sort_keys=True)
+                st.session_state.desc_based_on_meta = st.session_state.accepted_sig
             except Exception as e:
                 st.error(f"Description generation failed: {e}")
 
@@ -261,7 +528,7 @@ if st.button("💾 Save (overwrite by swatch_id)", type="primary", use_container
         st.stop()
 
     # Safety: ensure description is based on current accepted snapshot
-    current_sig = json.dumps(accepted, sort_keys=True)
+    current_sig = st.session_state.accepted_sig
     if st.session_state.desc_based_on_meta is not None and st.session_state.desc_based_on_meta != current_sig:
         st.warning("Metadata changed since last description generation. Please regenerate description.")
         st.stop()
@@ -277,6 +544,7 @@ if st.button("💾 Save (overwrite by swatch_id)", type="primary", use_container
                 "suitable_for": accepted.get("suitable_for", ""),
                 "description": st.session_state.description.strip(),
                 "image_filename": filename,
+                "phash": image_ph,
             })
             st.success("Saved ✅ (If swatch_id existed, it was overwritten.)")
         except Exception as e:
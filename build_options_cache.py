@@ -0,0 +1,20 @@
+"""
+Builds options.arrow from the three option CSVs so the app can skip CSV
+parsing on cold start. Re-run whenever a CSV changes (load_options falls
+back to the CSVs automatically if the cache is older than them).
+
+Usage:
+  python build_options_cache.py
+"""
+from options_loader import OPTIONS_CACHE_PATH, load_options_from_csv, write_options_cache
+
+def main() -> None:
+    colors, designs, themes = load_options_from_csv()
+    write_options_cache(OPTIONS_CACHE_PATH, colors, designs, themes)
+    print(
+        f"Wrote {OPTIONS_CACHE_PATH}: "
+        f"{len(colors)} colors, {len(designs)} designs, {len(themes)} themes"
+    )
+
+if __name__ == "__main__":
+    main()
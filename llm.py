@@ -1,32 +1,47 @@
 import base64
-import json
-from typing import Any, Dict, List
-from openai import OpenAI
+import functools
+import io
+from typing import Any, Dict, List, Optional, Tuple
+import orjson
+from imagehash import phash
+from openai import AsyncOpenAI, OpenAI
+from PIL import Image
 
-def _b64_image(image_bytes: bytes) -> str:
-    return base64.b64encode(image_bytes).decode("utf-8")
+MODEL = "gpt-4o-mini"
 
-def extract_metadata(
-    client: OpenAI,
-    image_bytes: bytes,
-    color_options: List[str],
-    design_options: List[str],
-    theme_options: List[str],
-) -> Dict[str, Any]:
+# Longest side sent to the vision model; enough for colour/pattern detail.
+MAX_IMAGE_SIDE = 1024
+JPEG_QUALITY = 85
+
+def _prepare_image(image_bytes: bytes) -> bytes:
     """
-    GPT Vision extraction:
-      returns dict with keys:
-        primary_color (str),
-        secondary_colors (list[str]),
-        design_style (str),
-        theme (str),
-        suitable_for (str)
+    Downscale to MAX_IMAGE_SIDE and re-encode as JPEG so large phone photos
+    don't cost seconds of upload (and image tokens) per request.
     """
-    img_b64 = _b64_image(image_bytes)
+    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
 
-    # Keep options in prompt, but avoid extremely long content if lists are huge.
-    # If your lists are very large (1000s), we can optimize later.
-    prompt = f"""
+def encode_image(image_bytes: bytes) -> str:
+    """
+    Downscaled JPEG as base64, ready for the input_image data URL.
+    Callers may cache this and pass it to extract_metadata(img_b64=...).
+    """
+    return base64.b64encode(_prepare_image(image_bytes)).decode("utf-8")
+
+def image_phash(image_bytes: bytes) -> int:
+    """
+    64-bit perceptual hash as a signed int (fits a Postgres bigint), used
+    to spot re-uploads of the same swatch (see db.find_similar).
+    """
+    h = int(str(phash(Image.open(io.BytesIO(image_bytes)))), 16)
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+# Keep options in prompt, but avoid extremely long content if lists are huge.
+# If your lists are very large (1000s), we can optimize later.
+_METADATA_PROMPT_TMPL = """
 You are extracting wallpaper swatch metadata from an image.
 
 CRITICAL RULES:
@@ -36,50 +51,132 @@ CRITICAL RULES:
 - theme MUST be exactly one of the THEME OPTIONS.
 - suitable_for can be short free text (e.g., "Living room, Bedroom").
 - Do NOT invent new labels outside the options.
-- Output ONLY valid JSON (no markdown, no commentary).
-
-Required JSON shape:
-{{
-  "primary_color": "one color option",
-  "secondary_colors": ["color option", "..."],
-  "design_style": "one design style option",
-  "theme": "one theme option",
-  "suitable_for": "free text"
-}}
 
 COLOR OPTIONS:
-{color_options}
+{colors}
 
 DESIGN STYLE OPTIONS:
-{design_options}
+{designs}
 
 THEME OPTIONS:
-{theme_options}
+{themes}
 """.strip()
 
+@functools.lru_cache(maxsize=4)
+def _metadata_prompt(
+    color_options: Tuple[str, ...],
+    design_options: Tuple[str, ...],
+    theme_options: Tuple[str, ...],
+) -> str:
+    # Options rarely change within a session, so this renders once.
+    return _METADATA_PROMPT_TMPL.format(
+        colors=list(color_options),
+        designs=list(design_options),
+        themes=list(theme_options),
+    )
+
+@functools.lru_cache(maxsize=4)
+def _metadata_format(
+    color_options: Tuple[str, ...],
+    design_options: Tuple[str, ...],
+    theme_options: Tuple[str, ...],
+) -> Dict[str, Any]:
+    """
+    Strict JSON Schema for the Responses API `text.format`, so output is
+    always parseable and categorical values are always in the option lists.
+    Cached and shared between calls: do not mutate the returned dict.
+    """
+    return {
+        "type": "json_schema",
+        "name": "swatch_metadata",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "primary_color": {"type": "string", "enum": list(color_options)},
+                "secondary_colors": {
+                    "type": "array",
+                    "items": {"type": "string", "enum": list(color_options)},
+                    "maxItems": 6,
+                },
+                "design_style": {"type": "string", "enum": list(design_options)},
+                "theme": {"type": "string", "enum": list(theme_options)},
+                "suitable_for": {"type": "string"},
+            },
+            "required": ["primary_color", "secondary_colors", "design_style", "theme", "suitable_for"],
+            "additionalProperties": False,
+        },
+    }
+
+def _metadata_input(prompt: str, img_b64: str) -> List[Dict[str, Any]]:
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": prompt},
+                {"type": "input_image", "image_url": f"data:image/jpeg;base64,{img_b64}"},
+            ],
+        }
+    ]
+
+def extract_metadata(
+    client: OpenAI,
+    image_bytes: bytes,
+    color_options: List[str],
+    design_options: List[str],
+    theme_options: List[str],
+    img_b64: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    GPT Vision extraction:
+      returns dict with keys:
+        primary_color (str),
+        secondary_colors (list[str]),
+        design_style (str),
+        theme (str),
+        suitable_for (str)
+    If img_b64 (from encode_image) is given, image_bytes is not re-encoded.
+    """
+    if img_b64 is None:
+        img_b64 = encode_image(image_bytes)
+    opts = (tuple(color_options), tuple(design_options), tuple(theme_options))
+
     resp = client.responses.create(
-        model="gpt-4o-mini",
-        input=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": prompt},
-                    {"type": "input_image", "image_url": f"data:image/png;base64,{img_b64}"},
-                ],
-            }
-        ],
+        model=MODEL,
+        input=_metadata_input(_metadata_prompt(*opts), img_b64),
+        text={"format": _metadata_format(*opts)},
     )
 
-    raw = (resp.output_text or "").strip()
-    # Try strict JSON parse. If model returns extra text, attempt to recover.
-    return _safe_json_load(raw)
+    # Structured outputs guarantee schema-valid JSON.
+    return orjson.loads(resp.output_text)
 
-def generate_description(client: OpenAI, accepted_meta: Dict[str, Any]) -> str:
+async def extract_metadata_async(
+    client: AsyncOpenAI,
+    image_bytes: bytes,
+    color_options: List[str],
+    design_options: List[str],
+    theme_options: List[str],
+    img_b64: Optional[str] = None,
+) -> Dict[str, Any]:
     """
-    Description MUST be based only on accepted_meta (no image).
-    2-4 sentences, unformatted, focuses on first 4 attributes.
+    Async variant of extract_metadata (same prompt and return shape),
+    used by parallel_processor to fan out many images at once.
+    Pass img_b64 (encoded off the event loop) to avoid blocking it here.
     """
-    meta_json = json.dumps(accepted_meta, ensure_ascii=False)
+    if img_b64 is None:
+        img_b64 = encode_image(image_bytes)
+    opts = (tuple(color_options), tuple(design_options), tuple(theme_options))
+
+    resp = await client.responses.create(
+        model=MODEL,
+        input=_metadata_input(_metadata_prompt(*opts), img_b64),
+        text={"format": _metadata_format(*opts)},
+    )
+
+    return orjson.loads(resp.output_text)
+
+def _description_prompt(accepted_meta: Dict[str, Any]) -> str:
+    meta_json = orjson.dumps(accepted_meta).decode("utf-8")
 
     prompt = f"""
 Write a short, unformatted description of this wallpaper swatch.
@@ -100,9 +197,26 @@ ACCEPTED METADATA (JSON):
 {meta_json}
 """.strip()
 
+    return prompt
+
+def generate_description(client: OpenAI, accepted_meta: Dict[str, Any]) -> str:
+    """
+    Description MUST be based only on accepted_meta (no image).
+    2-4 sentences, unformatted, focuses on first 4 attributes.
+    """
     resp = client.responses.create(
-        model="gpt-4o-mini",
-        input=prompt,
+        model=MODEL,
+        input=_description_prompt(accepted_meta),
+    )
+    return (resp.output_text or "").strip()
+
+async def generate_description_async(client: AsyncOpenAI, accepted_meta: Dict[str, Any]) -> str:
+    """
+    Async variant of generate_description.
+    """
+    resp = await client.responses.create(
+        model=MODEL,
+        input=_description_prompt(accepted_meta),
     )
     return (resp.output_text or "").strip()
 
@@ -137,23 +251,128 @@ def validate_categorical(
 
     return errs
 
-def _safe_json_load(text: str) -> Dict[str, Any]:
+# ---------- OpenAI Batch API (async, ~24h turnaround, ~50% cost) ----------
+# For bulk catalog backfills: requests are queued server-side and do not
+# consume the real-time RPM/TPM quota used by the interactive app.
+
+def _batch_request_line(
+    swatch_id: str,
+    image_filename: str,
+    image_bytes: bytes,
+    opts: Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[str, ...]],
+) -> Dict[str, Any]:
+    return {
+        "custom_id": swatch_id,
+        "method": "POST",
+        "url": "/v1/responses",
+        "body": {
+            "model": MODEL,
+            "input": _metadata_input(_metadata_prompt(*opts), encode_image(image_bytes)),
+            "text": {"format": _metadata_format(*opts)},
+            # Echoed back on the response, so results can be saved without local state.
+            "metadata": {"image_filename": image_filename, "phash": str(image_phash(image_bytes))},
+        },
+    }
+
+def submit_batch(
+    client: OpenAI,
+    images: List[Tuple[str, str, bytes]],
+    color_options: List[str],
+    design_options: List[str],
+    theme_options: List[str],
+) -> str:
+    """
+    Enqueue metadata extraction for many images via /v1/batches.
+    images: list of (swatch_id, image_filename, image_bytes); swatch_id is
+    used as custom_id (duplicates keep the last image).
+    Returns the batch id (see poll_batch / load_batch_results).
+    """
+    opts = (tuple(color_options), tuple(design_options), tuple(theme_options))
+    by_id = {sid: (sid, fn, b) for sid, fn, b in images}
+    jsonl = b"\n".join(
+        orjson.dumps(_batch_request_line(sid, fn, b, opts))
+        for sid, fn, b in by_id.values()
+    )
+
+    input_file = client.files.create(file=("swatch_batch.jsonl", jsonl), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/responses",
+        completion_window="24h",
+    )
+    return batch.id
+
+def poll_batch(client: OpenAI, batch_id: str) -> Dict[str, Any]:
+    """
+    Returns status info: status, request_counts (completed/failed/total),
+    output_file_id, error_file_id.
+    """
+    batch = client.batches.retrieve(batch_id)
+    counts = batch.request_counts
+    return {
+        "status": batch.status,
+        "completed": counts.completed if counts else 0,
+        "failed": counts.failed if counts else 0,
+        "total": counts.total if counts else 0,
+        "output_file_id": batch.output_file_id,
+        "error_file_id": batch.error_file_id,
+    }
+
+def _response_body_text(body: Dict[str, Any]) -> str:
+    # Raw Responses JSON has no output_text convenience field; join message text parts.
+    parts = []
+    for item in body.get("output") or []:
+        if item.get("type") != "message":
+            continue
+        for c in item.get("content") or []:
+            if c.get("type") == "output_text":
+                parts.append(c.get("text", ""))
+    return "".join(parts)
+
+def load_batch_results(client: OpenAI, batch_id: str) -> List[Dict[str, Any]]:
     """
-    Attempts to parse JSON even if there is stray text.
-    Strategy:
-      1) direct json.loads
-      2) find first '{' and last '}' and parse substring
+    Parse a finished batch into rows shaped like parallel_processor.process_batch
+    output (upsert_swatch keys + "errors"), with an empty description.
+    Raises ValueError if the batch has not completed.
     """
-    try:
-        return json.loads(text)
-    except Exception:
-        pass
+    info = poll_batch(client, batch_id)
+    if info["status"] != "completed":
+        raise ValueError(f"Batch {batch_id} is not completed (status: {info['status']}).")
 
-    start = text.find("{")
-    end = text.rfind("}")
-    if start != -1 and end != -1 and end > start:
-        candidate = text[start : end + 1]
-        return json.loads(candidate)
+    lines: List[bytes] = []
+    for file_id in (info["output_file_id"], info["error_file_id"]):
+        if file_id:
+            lines.extend(client.files.content(file_id).content.splitlines())
 
-    # If still fails, raise a helpful error
-    raise ValueError("Could not parse JSON from model output.")
+    rows = []
+    for line in lines:
+        if not line.strip():
+            continue
+        rec = orjson.loads(line)
+        row: Dict[str, Any] = {
+            "swatch_id": rec["custom_id"],
+            "image_filename": None,
+            "phash": None,
+            "primary_color": "",
+            "secondary_colors": [],
+            "design_style": "",
+            "theme": "",
+            "suitable_for": "",
+            "description": "",
+            "errors": [],
+        }
+        resp = rec.get("response") or {}
+        body = resp.get("body") or {}
+        if rec.get("error") or resp.get("status_code") != 200:
+            err = rec.get("error") or body.get("error") or {}
+            row["errors"] = [err.get("message") or f"request failed (status {resp.get('status_code')})"]
+        else:
+            meta = body.get("metadata") or {}
+            row["image_filename"] = meta.get("image_filename")
+            row["phash"] = int(meta["phash"]) if meta.get("phash") else None
+            try:
+                row.update(orjson.loads(_response_body_text(body)))
+            except orjson.JSONDecodeError:
+                row["errors"] = ["Could not parse JSON from model output."]
+        rows.append(row)
+    return rows
@@ -0,0 +1,8 @@
+-- Store secondary_colors as native jsonb instead of JSON text.
+-- Existing rows already hold valid JSON arrays, so a direct cast is safe.
+-- Required, and applied manually (rewrites the table; not run on startup):
+--   psql "$DATABASE_URL" -f migrations/001_secondary_colors_jsonb.sql
+-- db.get_engine refuses to start while the column is still text.
+alter table swatch_metadata
+  alter column secondary_colors type jsonb
+  using secondary_colors::jsonb;
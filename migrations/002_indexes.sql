@@ -0,0 +1,5 @@
+-- Serves "order by updated_at desc [limit n]" and max(updated_at) as index scans.
+-- INCLUDE lets narrow listings of these columns skip heap lookups (PG11+).
+create index if not exists swatch_updated_at_idx
+  on swatch_metadata (updated_at desc)
+  include (swatch_id, primary_color, design_style, theme);
@@ -0,0 +1,4 @@
+-- Containment queries on secondary_colors. Requires 001 (jsonb column);
+-- get_engine skips this file with a warning while the column is still text.
+create index if not exists swatch_secondary_gin
+  on swatch_metadata using gin (secondary_colors);
@@ -0,0 +1,5 @@
+-- 64-bit perceptual hash of the swatch image (signed bigint), used to
+-- reuse metadata for near-duplicate uploads instead of calling the model.
+-- Unindexed: lookups filter on bit_count(phash # h), which no btree can serve.
+alter table swatch_metadata
+  add column if not exists phash bigint;
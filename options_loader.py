@@ -1,9 +1,33 @@
+import os
 import pandas as pd
 
+OPTIONS_CACHE_PATH = "options.arrow"
+
 def load_options(
     color_csv_path: str = "color_options.csv",
     design_csv_path: str = "design_options.csv",
     theme_csv_path: str = "Theme_options.csv",
+    cache_path: str = OPTIONS_CACHE_PATH,
+):
+    """
+    Loads allowed categorical options.
+
+    Reads the prebuilt Arrow cache (see build_options_cache.py) when it is
+    present and newer than all three CSVs; otherwise falls back to parsing
+    the CSVs directly.
+    """
+    csv_paths = (color_csv_path, design_csv_path, theme_csv_path)
+    if _cache_is_fresh(cache_path, csv_paths):
+        try:
+            return _read_options_cache(cache_path)
+        except Exception:
+            pass  # corrupt/unreadable cache -> CSV fallback
+    return load_options_from_csv(*csv_paths)
+
+def load_options_from_csv(
+    color_csv_path: str = "color_options.csv",
+    design_csv_path: str = "design_options.csv",
+    theme_csv_path: str = "Theme_options.csv",
 ):
     """
     Loads allowed categorical options from CSVs.
@@ -24,39 +48,57 @@ def load_options(
     if "THEMES" not in theme_df.columns:
         raise ValueError("Theme_options.csv must contain column 'THEMES'")
 
-    colors = (
-        color_df["GENERIC NAMES"]
-        .dropna()
-        .astype(str)
-        .map(lambda s: s.strip())
-        .loc[lambda s: s != ""]
-        .unique()
-        .tolist()
-    )
+    # Sorted for UI consistency
+    colors = _clean_values(color_df["GENERIC NAMES"])
+    designs = _clean_values(design_df["DESIGN STYLE"])
+    themes = _clean_values(theme_df["THEMES"])
 
-    designs = (
-        design_df["DESIGN STYLE"]
-        .dropna()
-        .astype(str)
-        .map(lambda s: s.strip())
-        .loc[lambda s: s != ""]
-        .unique()
-        .tolist()
-    )
+    return colors, designs, themes
 
-    themes = (
-        theme_df["THEMES"]
-        .dropna()
-        .astype(str)
-        .map(lambda s: s.strip())
-        .loc[lambda s: s != ""]
-        .unique()
-        .tolist()
-    )
+def _clean_values(col: pd.Series):
+    """
+    Strip, drop blanks, dedupe and sort in one vectorized pass
+    (.str.strip runs in pandas' C path, no per-cell Python lambda).
+    """
+    s = col.dropna().astype(str).str.strip()
+    return sorted(set(s[s != ""]))
+
+def write_options_cache(cache_path, colors, designs, themes) -> None:
+    """
+    Writes cleaned, sorted option lists to a single Arrow IPC file.
+    Columns are padded with nulls to a common length.
+    """
+    import pyarrow as pa
 
-    # Optional: stable sorting for UI consistency
-    colors.sort()
-    designs.sort()
-    themes.sort()
+    n = max(len(colors), len(designs), len(themes))
 
-    return colors, designs, themes
+    def _pad(vals):
+        return pa.array(list(vals) + [None] * (n - len(vals)), type=pa.string())
+
+    table = pa.table({
+        "colors": _pad(colors),
+        "designs": _pad(designs),
+        "themes": _pad(themes),
+    })
+    with pa.OSFile(cache_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+def _read_options_cache(cache_path):
+    import pyarrow as pa
+
+    with pa.memory_map(cache_path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    return tuple(
+        table.column(name).drop_null().to_pylist()
+        for name in ("colors", "designs", "themes")
+    )
+
+def _cache_is_fresh(cache_path, csv_paths) -> bool:
+    if not os.path.exists(cache_path):
+        return False
+    cache_mtime = os.path.getmtime(cache_path)
+    return all(
+        not os.path.exists(p) or os.path.getmtime(p) <= cache_mtime
+        for p in csv_paths
+    )
@@ -0,0 +1,183 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, RateLimitError
+
+from llm import (
+    encode_image, extract_metadata_async, generate_description_async, image_phash,
+    validate_categorical,
+)
+
+# Rough per-request token estimates used only for client-side throttling.
+# A swatch image + options prompt is ~1-2k tokens; the description call is small.
+EXTRACT_TOKEN_ESTIMATE = 2000
+DESCRIBE_TOKEN_ESTIMATE = 500
+
+MAX_ATTEMPTS = 3
+BASE_BACKOFF_SECONDS = 1.0
+
+_META_KEYS = ("primary_color", "secondary_colors", "design_style", "theme", "suitable_for")
+
+class _CapacityTracker:
+    """
+    Client-side RPM/TPM throttle (same idea as openai-cookbook's
+    api_request_parallel_processor): capacity refills continuously and is
+    decremented before each request is dispatched.
+    """
+
+    def __init__(self, max_requests_per_minute: float, max_tokens_per_minute: float):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.max_requests_per_minute * elapsed / 60.0,
+            self.max_requests_per_minute,
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60.0,
+            self.max_tokens_per_minute,
+        )
+        self.last_update_time = now
+
+    async def acquire(self, tokens: int) -> None:
+        while True:
+            self._refill()
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= tokens
+                return
+            await asyncio.sleep(0.05)
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(exc, APIStatusError) and exc.status_code >= 500
+
+async def _call_with_retry(
+    capacity: _CapacityTracker,
+    tokens: int,
+    call: Callable[[], Awaitable[Any]],
+) -> Any:
+    """
+    Throttle, then run call(). Retries 429 / 5xx / connection errors with
+    exponential backoff, up to MAX_ATTEMPTS total attempts.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        await capacity.acquire(tokens)
+        try:
+            return await call()
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS - 1 or not _is_retryable(e):
+                raise
+            await asyncio.sleep(BASE_BACKOFF_SECONDS * (2 ** attempt))
+
+async def process_batch(
+    client: AsyncOpenAI,
+    images: List[Tuple[str, str, bytes]],
+    color_options: List[str],
+    design_options: List[str],
+    theme_options: List[str],
+    num_concurrent: int = 10,
+    max_requests_per_minute: float = 500,
+    max_tokens_per_minute: float = 200_000,
+) -> List[Dict[str, Any]]:
+    """
+    Extract metadata + description for many images concurrently.
+
+    images: list of (swatch_id, image_filename, image_bytes).
+    Returns one dict per image (same order) with the upsert_swatch row keys
+    plus "errors" (list[str]). Rows whose metadata fails validation are
+    returned without a description so they can be fixed before saving.
+    """
+    color_set, design_set, theme_set = set(color_options), set(design_options), set(theme_options)
+    semaphore = asyncio.Semaphore(num_concurrent)
+    capacity = _CapacityTracker(max_requests_per_minute, max_tokens_per_minute)
+
+    async def _one(swatch_id: str, filename: str, image_bytes: bytes) -> Dict[str, Any]:
+        result: Dict[str, Any] = {
+            "swatch_id": swatch_id,
+            "image_filename": filename,
+            "phash": None,
+            "primary_color": "",
+            "secondary_colors": [],
+            "design_style": "",
+            "theme": "",
+            "suitable_for": "",
+            "description": "",
+            "errors": [],
+        }
+        async with semaphore:
+            # Pillow decode/resize/encode and pHash are CPU work: run them in a
+            # worker thread (not the event loop) and only once, outside the retries.
+            try:
+                result["phash"] = await asyncio.to_thread(image_phash, image_bytes)
+            except Exception:
+                pass  # dedup is best-effort; the row is still extracted and saved
+            try:
+                img_b64 = await asyncio.to_thread(encode_image, image_bytes)
+                meta = await _call_with_retry(
+                    capacity,
+                    EXTRACT_TOKEN_ESTIMATE,
+                    lambda: extract_metadata_async(
+                        client, image_bytes, color_options, design_options, theme_options,
+                        img_b64=img_b64,
+                    ),
+                )
+                for k in _META_KEYS:
+                    if meta.get(k) is not None:
+                        result[k] = meta[k]
+
+                errs = validate_categorical(result, color_set, design_set, theme_set)
+                if errs:
+                    result["errors"] = errs
+                    return result
+
+                accepted = {k: result[k] for k in _META_KEYS}
+                result["description"] = await _call_with_retry(
+                    capacity,
+                    DESCRIBE_TOKEN_ESTIMATE,
+                    lambda: generate_description_async(client, accepted),
+                )
+            except Exception as e:
+                result["errors"] = [str(e)]
+        return result
+
+    return await asyncio.gather(*(_one(sid, fn, b) for sid, fn, b in images))
+
+async def describe_batch(
+    client: AsyncOpenAI,
+    rows: List[Dict[str, Any]],
+    num_concurrent: int = 10,
+    max_requests_per_minute: float = 500,
+    max_tokens_per_minute: float = 200_000,
+) -> List[Dict[str, Any]]:
+    """
+    Fill "description" for rows that already have metadata (e.g. from
+    llm.load_batch_results). Rows with errors are skipped; a failed call
+    records its error on the row. Returns the same list, updated in place.
+    """
+    semaphore = asyncio.Semaphore(num_concurrent)
+    capacity = _CapacityTracker(max_requests_per_minute, max_tokens_per_minute)
+
+    async def _one(row: Dict[str, Any]) -> None:
+        if row.get("errors"):
+            return
+        accepted = {k: row.get(k) for k in _META_KEYS}
+        async with semaphore:
+            try:
+                row["description"] = await _call_with_retry(
+                    capacity,
+                    DESCRIBE_TOKEN_ESTIMATE,
+                    lambda: generate_description_async(client, accepted),
+                )
+            except Exception as e:
+                row["errors"] = [str(e)]
+
+    await asyncio.gather(*(_one(r) for r in rows))
+    return rows